@@ -1,36 +1,42 @@
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI, HTTPException, Request, Depends
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 import os
-import tempfile
 import logging
 import io
+import codecs
+import itertools
+import csv
+import re
  
 from dotenv import load_dotenv
 import secrets
 import aiomysql
+from aiomysql.cursors import SSCursor, SSDictCursor
 import asyncpg
 import asyncio
-from typing import Union
+import contextlib
+import time
+import weakref
+from typing import Optional, Union
 from slowapi import Limiter
-from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from starlette.status import HTTP_429_TOO_MANY_REQUESTS
-from fastapi.responses import JSONResponse
-import json
-import datetime
+from fastapi.responses import Response
+import orjson
 from decimal import Decimal
+import datetime
 
-# Custom JSON encoder to handle date/datetime/decimal objects
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, (datetime.date, datetime.datetime)):
-            return obj.isoformat()
-        elif isinstance(obj, datetime.time):
-            return obj.isoformat()
-        elif isinstance(obj, Decimal):
-            return float(obj)
-        return super().default(obj)
+# Dates and times go through default (OPT_PASSTHROUGH_DATETIME): orjson rejects tz-aware
+# time values such as PostgreSQL timetz, and isoformat() matches the earlier JSON encoder
+def _json_default(obj):
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, asyncpg.Record):
+        return dict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 # Configure logging from environment variables
 LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
@@ -62,18 +68,34 @@ app = FastAPI()
 # Rate limiting configuration
 RATE_LIMIT = os.getenv("RATE_LIMIT", "100/hour")
 RATE_LIMIT_MESSAGE = "Rate limit exceeded. Please try again later or contact your administrator."
+RATE_LIMIT_BODY = orjson.dumps({"detail": RATE_LIMIT_MESSAGE})
 logger.info(f"Using rate limit: {RATE_LIMIT}")
 
+# Number of reverse proxies in front of the app that append to X-Forwarded-For.
+# 0 (default) ignores the header, since clients can send any value in it.
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+
+def _client_key(request: Request) -> str:
+    """Rate-limit key: the peer address, or the hop recorded by our trusted proxies."""
+    if TRUSTED_PROXY_COUNT > 0:
+        forwarded_for = request.headers.get("x-forwarded-for")
+        if forwarded_for:
+            # Entries left of the ones our proxies appended are client-supplied
+            hops = forwarded_for.split(",")
+            return hops[-min(TRUSTED_PROXY_COUNT, len(hops))].strip()
+    return request.client.host if request.client else "unknown"
+
 # Initialize SlowAPI limiter
-limiter = Limiter(key_func=get_remote_address)
+limiter = Limiter(key_func=_client_key)
 app.state.limiter = limiter
 
 # Custom 429 handler
 @app.exception_handler(RateLimitExceeded)
-async def custom_rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded) -> JSONResponse:
-    return JSONResponse(
+async def custom_rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded) -> Response:
+    return Response(
         status_code=HTTP_429_TOO_MANY_REQUESTS,
-        content={"detail": RATE_LIMIT_MESSAGE}
+        content=RATE_LIMIT_BODY,
+        media_type="application/json",
     )
 
 
@@ -102,23 +124,46 @@ if not API_KEY:
     raise RuntimeError("API_KEY env var not set")
 
 # Database connection pool configuration
-DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
-DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "4"))
+# Both drivers open DB_POOL_MIN_SIZE connections when the pool is created, so
+# startup pays the TCP/TLS/auth handshakes instead of the first requests
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "4"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "16"))
+DB_POOL_MAX_QUERIES = int(os.getenv("DB_POOL_MAX_QUERIES", "50000"))
 DB_POOL_MAX_INACTIVE_LIFETIME = int(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
 DB_POOL_RECYCLE_TIME = int(os.getenv("DB_POOL_RECYCLE_TIME", "1800"))
-DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "0"))
+# Hard cap on connection age in seconds (0 disables); guards against stale sockets behind NAT.
+# Checked per connection on acquire, so only connections past the limit are replaced.
+DB_POOL_MAX_LIFETIME = int(os.getenv("DB_POOL_MAX_LIFETIME", str(DB_POOL_RECYCLE_TIME)))
+# asyncpg prepared-statement cache per provider; 0 disables it for transaction poolers
+# (PgBouncer/Supavisor) that cannot keep prepared statements. DB_STATEMENT_CACHE_SIZE,
+# when set, overrides the per-provider values for every PostgreSQL pool.
+_statement_cache_env = os.getenv("DB_STATEMENT_CACHE_SIZE")
+DB_STATEMENT_CACHE_SIZE = int(_statement_cache_env) if _statement_cache_env else None
+PG_STATEMENT_CACHE_SIZES = {
+    "aiven_postgres": 100,
+    "neon_postgres": 100,
+    "supabase_postgres": 0,
+}
+# Ports conventionally used by transaction poolers: PgBouncer (6432), Supabase pooler (6543)
+PG_TRANSACTION_POOLER_PORTS = {6432, 6543}
+DB_CURSOR_PREFETCH = int(os.getenv("DB_CURSOR_PREFETCH", "1000"))
 
 # Database timeout configuration (in milliseconds)
 DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "180000"))
 DB_EXECUTION_TIMEOUT_MS = int(os.getenv("DB_EXECUTION_TIMEOUT_MS", "180000"))
+# MySQL error number for SET on a system variable the server does not have
+MYSQL_ER_UNKNOWN_SYSTEM_VARIABLE = 1193
 
 # Default database ports
 DEFAULT_MYSQL_PORT = 3306
 
 # File and response configuration
+MAX_JSON_ROWS = int(os.getenv("MAX_JSON_ROWS", "10000"))
+MAX_CSV_ROWS = int(os.getenv("MAX_CSV_ROWS", "1000000"))
 CSV_FILENAME = os.getenv("CSV_FILENAME", "results.csv")
-CSV_FILE_SUFFIX = os.getenv("CSV_FILE_SUFFIX", ".csv")
 CSV_ENCODING = os.getenv("CSV_ENCODING", "utf-8")
+CSV_STREAM_QUEUE_SIZE = 16
+CSV_STREAM_CHUNK_SIZE = int(os.getenv("CSV_STREAM_CHUNK_SIZE", "65536"))
 
 # Authentication error messages
 AUTH_MISSING_HEADER_MSG = "Missing Authorization header"
@@ -127,18 +172,146 @@ AUTH_INVALID_KEY_MSG = "Invalid API key"
 
 # Query execution messages
 QUERY_SUCCESS_MSG = "Query executed successfully"
+QUERY_SUCCESS_BODY = orjson.dumps({"status": QUERY_SUCCESS_MSG})
+
+# Leading keyword of statements that return rows; matched in place, case-insensitively
+_DATA_QUERY_RE = re.compile(r"\s*(select|show|describe|explain|with)\b", re.IGNORECASE)
+
+def _limit_query(sqlquery: str, limit: int) -> Optional[str]:
+    """Wrap a PostgreSQL SELECT/WITH query so the server stops after `limit` rows.
+
+    Returns None when the query cannot be wrapped safely, i.e. a ';' remains once
+    trailing semicolons and whitespace are stripped (a semicolon followed by a
+    trailing comment, or one inside the query); callers then run it unwrapped.
+    """
+    body = sqlquery.strip().rstrip("; \t\r\n")
+    if ";" in body:
+        return None
+    # The newline keeps a trailing "-- comment" from swallowing the closing paren
+    return f"SELECT * FROM ({body}\n) AS _q LIMIT {limit}"
 
 # Server configuration
 SERVER_HOST = "0.0.0.0"
 SERVER_PORT = 8000
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# ---------- CSV serialization ----------
+# Shared dialect for every CSV export (comma-separated, minimal quoting, CRLF)
+_CSV_DIALECT = csv.excel
+
+def _take_csv_chunk(buffer: io.StringIO, encoder: codecs.IncrementalEncoder) -> bytes:
+    """Return what the csv.writer has written so far and reset the buffer."""
+    chunk = encoder.encode(buffer.getvalue())
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk
+
+async def _iter_cursor_csv(columns, fetch_batch, max_rows: int):
+    """Yield the header, then up to max_rows rows in batches of DB_CURSOR_PREFETCH."""
+    # csv.writer quotes and joins tuple rows in C; no per-row dicts or Python-level escaping
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, dialect=_CSV_DIALECT)
+    # One encoder per stream, so codecs like utf-8-sig emit their BOM only once
+    encoder = codecs.getincrementalencoder(CSV_ENCODING)()
+    writer.writerow(columns)
+    yield _take_csv_chunk(buffer, encoder)
+    remaining = max_rows
+    while remaining > 0:
+        rows = await fetch_batch(min(DB_CURSOR_PREFETCH, remaining))
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield _take_csv_chunk(buffer, encoder)
+        remaining -= len(rows)
+
+def _batch_fetcher(rows):
+    """Adapt rows already in memory to the fetch_batch(n) interface of _iter_cursor_csv."""
+    rows = iter(rows)
+
+    async def fetch_batch(n: int):
+        return list(itertools.islice(rows, n))
+
+    return fetch_batch
+
+async def _iter_copy_csv(connection, query: str):
+    """Yield the output of a PostgreSQL COPY ... TO STDOUT as asyncpg receives it."""
+    # COPY writes in the client encoding, which asyncpg pins to UTF-8; CSV_ENCODING is a
+    # Python codec name, so any other encoding is applied here rather than by the server
+    if codecs.lookup(CSV_ENCODING).name == "utf-8":
+        transcode = bytes  # asyncpg hands the sink bytearrays; Starlette only passes bytes through
+    else:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        encoder = codecs.getincrementalencoder(CSV_ENCODING)()
+        transcode = lambda chunk: encoder.encode(decoder.decode(chunk))
+    queue = asyncio.Queue(maxsize=CSV_STREAM_QUEUE_SIZE)
+    copy_task = asyncio.create_task(
+        connection.copy_from_query(
+            query,
+            output=queue.put,
+            format="csv",
+            header=True,
+        )
+    )
+    try:
+        while True:
+            if not queue.empty():
+                yield transcode(queue.get_nowait())
+            elif copy_task.done():
+                copy_task.result()  # Re-raise any COPY error
+                return
+            else:
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait({getter, copy_task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield transcode(getter.result())
+                else:
+                    getter.cancel()
+    finally:
+        if not copy_task.done():
+            copy_task.cancel()
+            await asyncio.gather(copy_task, return_exceptions=True)
+
+async def _stream_csv(first_chunk: bytes, chunks, resources: contextlib.AsyncExitStack):
+    """Response body for CSV exports; closes the cursor and releases the connection at the end."""
+    try:
+        yield first_chunk
+        # COPY hands over whatever each socket read contained, often only a few rows;
+        # coalesce into CSV_STREAM_CHUNK_SIZE writes to cut per-chunk ASGI send overhead
+        pending = bytearray()
+        async for chunk in chunks:
+            pending += chunk
+            if len(pending) >= CSV_STREAM_CHUNK_SIZE:
+                yield bytes(pending)
+                pending.clear()
+        if pending:
+            yield bytes(pending)
+    except Exception as e:
+        logger.error(f"Error streaming CSV: {e}")
+        raise
+    finally:
+        await chunks.aclose()
+        await resources.aclose()
 
 # ---------- Connection pool management ----------
+# When each pooled asyncpg connection was opened, for DB_POOL_MAX_LIFETIME
+# (aiomysql keeps this on the connection as connected_time)
+_connection_created_at = weakref.WeakKeyDictionary()
+
 async def _pg_pool_init(conn: asyncpg.Connection) -> None:
+    _connection_created_at[conn] = time.monotonic()
     # Enforce read-only transactions on PostgreSQL connections
     await conn.execute("SET default_transaction_read_only=on")
     # Set statement timeout from environment variable (milliseconds)
     await conn.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
 
+def _pg_statement_cache_size(cloud: str, port) -> int:
+    """Pick the asyncpg statement_cache_size for a PostgreSQL pool."""
+    if DB_STATEMENT_CACHE_SIZE is not None:
+        return DB_STATEMENT_CACHE_SIZE
+    if port in PG_TRANSACTION_POOLER_PORTS:
+        return 0
+    return PG_STATEMENT_CACHE_SIZES.get(cloud, 0)
+
 @app.on_event("startup")
 async def startup_create_pools() -> None:
     app.state.db_pools = {}
@@ -159,18 +332,24 @@ async def startup_create_pools() -> None:
         scheme = parsed.scheme.lower()
         try:
             if "postgres" in scheme:
+                statement_cache_size = _pg_statement_cache_size(cloud, parsed.port)
                 pool = await asyncpg.create_pool(
                     dsn=db_uri,
                     min_size=DB_POOL_MIN_SIZE,
                     max_size=DB_POOL_MAX_SIZE,
+                    max_queries=DB_POOL_MAX_QUERIES,
                     max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
                     init=_pg_pool_init,
-                    statement_cache_size=DB_STATEMENT_CACHE_SIZE,  # Disable prepared statements for pgbouncer compatibility
+                    statement_cache_size=statement_cache_size,
                 )
-                app.state.db_pools[cloud] = {"pool": pool, "db_type": "postgresql"}
-                logger.info(f"PostgreSQL pool created for {cloud}")
+                app.state.db_pools[cloud] = {
+                    "pool": pool,
+                    "db_type": "postgresql",
+                    "statement_cache_size": statement_cache_size,
+                }
+                logger.info(f"PostgreSQL pool created for {cloud} (statement cache size {statement_cache_size})")
             elif "mysql" in scheme:
-                pool = await aiomysql.create_pool(
+                mysql_pool_options = dict(
                     host=parsed.hostname,
                     user=parsed.username,
                     password=parsed.password,
@@ -181,6 +360,24 @@ async def startup_create_pools() -> None:
                     pool_recycle=DB_POOL_RECYCLE_TIME,
                     autocommit=True,
                 )
+                try:
+                    # Per-statement timeout (ms), applied once per physical connection
+                    pool = await aiomysql.create_pool(
+                        init_command=f"SET SESSION MAX_EXECUTION_TIME={DB_EXECUTION_TIMEOUT_MS}",
+                        **mysql_pool_options,
+                    )
+                    if DB_POOL_MIN_SIZE == 0:
+                        # An empty pool connects lazily; open one connection so an
+                        # unsupported init_command fails here rather than on a request
+                        async with pool.acquire():
+                            pass
+                except aiomysql.MySQLError as e:
+                    # Only an unknown-variable error means the server lacks MAX_EXECUTION_TIME
+                    # (e.g. MariaDB); connection failures and the like still surface
+                    if not e.args or e.args[0] != MYSQL_ER_UNKNOWN_SYSTEM_VARIABLE:
+                        raise
+                    logger.warning(f"MAX_EXECUTION_TIME not applied for {cloud} ({e}); continuing without per-statement timeout")
+                    pool = await aiomysql.create_pool(**mysql_pool_options)
                 app.state.db_pools[cloud] = {"pool": pool, "db_type": "mysql"}
                 logger.info(f"MySQL pool created for {cloud}")
             else:
@@ -188,6 +385,7 @@ async def startup_create_pools() -> None:
         except Exception as e:
             logger.exception(f"Failed to create pool for {cloud} from {env_var_name}: {e}")
 
+
 @app.on_event("shutdown")
 async def shutdown_close_pools() -> None:
     pools = getattr(app.state, "db_pools", {})
@@ -205,28 +403,57 @@ async def shutdown_close_pools() -> None:
 
 # Removed unused synchronous get_connection
 
-async def create_async_connection(cloud: str):
-    """Acquire a connection from the appropriate pool based on cloud provider."""
+@contextlib.asynccontextmanager
+async def acquire_connection(cloud: str):
+    """Acquire a connection from the cloud provider's pool; it is released on exit."""
     pools = getattr(app.state, "db_pools", {})
     if cloud not in pools:
         raise HTTPException(status_code=500, detail=f"No pool configured for cloud '{cloud}'")
 
     meta = pools[cloud]
-    if meta["db_type"] == "mysql":
-        # aiomysql returns a pooled connection via acquire()
-        conn = await meta["pool"].acquire()
-        try:
-            # Set per-statement timeout from environment variable in milliseconds (MySQL/MariaDB)
-            async with conn.cursor() as cur:
-                await cur.execute(f"SET SESSION MAX_EXECUTION_TIME={DB_EXECUTION_TIMEOUT_MS}")
-        except Exception:
-            # Some MySQL variants may not support MAX_EXECUTION_TIME; continue without failing
-            logger.debug("MAX_EXECUTION_TIME not supported; continuing without per-statement timeout")
-        return conn, "mysql"
-    else:
-        # asyncpg returns a connection via acquire()
-        conn = await meta["pool"].acquire()
-        return conn, "postgresql"
+    while True:
+        # aiomysql and asyncpg pools both release the connection when this block exits
+        async with meta["pool"].acquire() as conn:
+            if not _connection_expired(conn, meta["db_type"]):
+                yield conn, meta["db_type"]
+                logger.debug(f"Releasing pooled connection for cloud: {cloud}")
+                return
+            logger.debug(f"Replacing pooled connection older than {DB_POOL_MAX_LIFETIME}s for cloud: {cloud}")
+            # Both pools drop a closed connection on release and open a new one on demand
+            if meta["db_type"] == "postgresql":
+                conn.terminate()
+            else:
+                conn.close()
+        if meta["db_type"] == "mysql":
+            # aiomysql only notifies waiters when a live connection comes back; wake one
+            # so a request blocked on a full pool can open the freed slot
+            await meta["pool"]._wakeup()
+
+def _connection_expired(conn, db_type: str) -> bool:
+    """Whether a pooled connection has outlived DB_POOL_MAX_LIFETIME."""
+    if DB_POOL_MAX_LIFETIME <= 0:
+        return False
+    if db_type == "mysql":
+        # aiomysql records when the connection was opened, in event-loop time
+        return asyncio.get_running_loop().time() - conn.connected_time > DB_POOL_MAX_LIFETIME
+    # asyncpg hands out a proxy; the age is recorded against the connection it wraps
+    created_at = _connection_created_at.get(conn._con)
+    return created_at is not None and time.monotonic() - created_at > DB_POOL_MAX_LIFETIME
+
+# sql_select_limit last applied to each pooled MySQL connection
+_mysql_select_limits = weakref.WeakKeyDictionary()
+
+async def set_mysql_select_limit(connection, limit: int) -> None:
+    """Cap the rows MySQL returns for top-level SELECTs on this session.
+
+    Unlike wrapping the query in a derived table this keeps ORDER BY intact, and an
+    explicit LIMIT in the query still takes precedence.
+    """
+    if _mysql_select_limits.get(connection) == limit:
+        return
+    async with connection.cursor() as cursor:
+        await cursor.execute(f"SET SESSION sql_select_limit = {limit}")
+    _mysql_select_limits[connection] = limit
 
 async def verify_api_key(request: Request):
     auth = request.headers.get("Authorization")
@@ -262,23 +489,17 @@ async def sqlquery(sqlquery: str, cloud: str, request: Request, format: str = "j
     if fmt not in {"json", "csv"}:
         raise HTTPException(status_code=400, detail="Invalid format. Use 'json' or 'csv'.")
 
-    max_json_rows = int(os.getenv("MAX_JSON_ROWS", "10000"))
-    max_csv_rows = int(os.getenv("MAX_CSV_ROWS", "1000000"))
-
-    connection = None
+    # Holds the pooled connection plus any open cursor/transaction; closed on return
+    # unless a streamed CSV response takes them over
+    resources = contextlib.AsyncExitStack()
     try:
         # Acquire pooled connection
-        connection, db_type = await create_async_connection(cloud)
+        connection, db_type = await resources.enter_async_context(acquire_connection(cloud))
 
         # Check if query returns data (SELECT, SHOW, DESCRIBE, EXPLAIN, etc.)
-        query_lower = sqlquery.strip().lower()
-        is_data_query = (
-            query_lower.startswith("select") or 
-            query_lower.startswith("show") or 
-            query_lower.startswith("describe") or 
-            query_lower.startswith("explain") or
-            query_lower.startswith("with")
-        )
+        kind_match = _DATA_QUERY_RE.match(sqlquery)
+        is_data_query = kind_match is not None
+        query_kind = kind_match.group(1).lower() if kind_match else None
         if not is_data_query:
             if db_type == "mysql":
                 async with connection.cursor() as cursor:
@@ -286,51 +507,92 @@ async def sqlquery(sqlquery: str, cloud: str, request: Request, format: str = "j
                     await connection.commit()
             else:
                 await connection.execute(sqlquery)
-            return {"status": QUERY_SUCCESS_MSG}
-
-        # Fetch data - simplified approach for both databases
-        if db_type == "mysql":
-            from aiomysql.cursors import DictCursor
-            async with connection.cursor(DictCursor) as cursor:
-                await cursor.execute(sqlquery)
-                rows = await cursor.fetchall()
-        else:
-            rows_pg = await connection.fetch(sqlquery)
-            rows = [dict(r) for r in rows_pg]
+            return Response(content=QUERY_SUCCESS_BODY, media_type="application/json")
+
+        # Let the server stop producing rows past the limit instead of discarding them here
+        is_select = query_kind in ("select", "with")
+        # Cursors and prepare() always create a named server-side statement, which a
+        # transaction pooler (statement cache 0) can hand to another client's backend;
+        # fetch() and COPY only use the unnamed statement
+        pg_named_statements = (
+            db_type == "postgresql" and app.state.db_pools[cloud]["statement_cache_size"] > 0
+        )
 
-        # Apply row limits
         if fmt == "json":
-            truncated = len(rows) > max_json_rows
-            if truncated:
-                rows = rows[:max_json_rows]
-            
-            # Use custom encoder to handle dates/decimals
-            response_data = {"rows": rows, "truncated": truncated}
-            json_content = json.dumps(response_data, cls=DateTimeEncoder, ensure_ascii=False)
-            return JSONResponse(content=json.loads(json_content), media_type="application/json")
-        
-        # CSV format - simplified
-        import csv
-        import io
-        
-        # Limit rows for CSV
-        csv_rows = rows[:max_csv_rows] if len(rows) > max_csv_rows else rows
-        
-        # Create CSV content in memory first
-        csv_buffer = io.StringIO()
-        if csv_rows:
-            writer = csv.DictWriter(csv_buffer, fieldnames=csv_rows[0].keys())
-            writer.writeheader()
-            writer.writerows(csv_rows)
-        
-        # Write to temp file
-        with tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix=CSV_FILE_SUFFIX, encoding=CSV_ENCODING) as temp_csv:
-            temp_csv.write(csv_buffer.getvalue())
-            temp_file_path = temp_csv.name
+            # Stream rows from a server-side cursor and stop once the limit is reached;
+            # the server-side cap is one row higher so truncation can still be detected
+            rows = []
+            truncated = False
+            if db_type == "mysql":
+                if is_select:
+                    await set_mysql_select_limit(connection, MAX_JSON_ROWS + 1)
+                async with connection.cursor(SSDictCursor) as cursor:
+                    await cursor.execute(sqlquery)
+                    async for row in cursor:
+                        if len(rows) == MAX_JSON_ROWS:
+                            truncated = True
+                            break
+                        rows.append(row)
+            else:
+                # Falls back to the client-side cap below when the query can't be wrapped
+                pg_query = (_limit_query(sqlquery, MAX_JSON_ROWS + 1) if is_select else None) or sqlquery
+                if pg_named_statements:
+                    async with connection.transaction():
+                        async for record in connection.cursor(pg_query, prefetch=DB_CURSOR_PREFETCH):
+                            if len(rows) == MAX_JSON_ROWS:
+                                truncated = True
+                                break
+                            rows.append(record)  # Converted by _json_default during serialization
+                else:
+                    records = await connection.fetch(pg_query)
+                    truncated = len(records) > MAX_JSON_ROWS
+                    rows = records[:MAX_JSON_ROWS]
+
+            # Serialize once with orjson and send the bytes as-is
+            payload = orjson.dumps(
+                {"rows": rows, "truncated": truncated},
+                default=_json_default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME,
+            )
+            return Response(content=payload, media_type="application/json")
         
-        return FileResponse(
-            path=temp_file_path, 
-            filename=CSV_FILENAME, 
+        # CSV format - streamed from the database
+        copy_query = _limit_query(sqlquery, MAX_CSV_ROWS) if db_type == "postgresql" and is_select else None
+        if copy_query:
+            # Server-side COPY renders the CSV; asyncpg hands over the raw chunks
+            chunks = _iter_copy_csv(connection, copy_query)
+        elif db_type == "mysql":
+            # MySQL has no COPY; stream tuples from an unbuffered cursor
+            if is_select:
+                await set_mysql_select_limit(connection, MAX_CSV_ROWS)
+            cursor = await resources.enter_async_context(connection.cursor(SSCursor))
+            await cursor.execute(sqlquery)
+            columns = [col[0] for col in cursor.description or ()]
+            chunks = _iter_cursor_csv(columns, cursor.fetchmany, MAX_CSV_ROWS)
+        else:
+            # PostgreSQL SHOW/EXPLAIN, and queries _limit_query can't wrap, cannot go
+            # through COPY; stream them from a cursor under the client-side cap
+            # (values are then formatted by csv.writer, not COPY; the README lists the differences)
+            if pg_named_statements:
+                await resources.enter_async_context(connection.transaction())
+                # Column names come from the prepared statement; Cursor does not expose them
+                stmt = await connection.prepare(sqlquery)
+                columns = [attr.name for attr in stmt.get_attributes()]
+                cursor = await stmt.cursor()
+                chunks = _iter_cursor_csv(columns, cursor.fetch, MAX_CSV_ROWS)
+            else:
+                # Behind a transaction pooler the rows are fetched in one go instead
+                records = await connection.fetch(sqlquery)
+                columns = list(records[0].keys()) if records else []
+                chunks = _iter_cursor_csv(columns, _batch_fetcher(records), MAX_CSV_ROWS)
+
+        # Pull the first chunk here so query errors still produce a proper 500
+        first_chunk = await chunks.__anext__()
+
+        # From here on the response body owns the connection and releases it
+        # after the last chunk is sent
+        return StreamingResponse(
+            _stream_csv(first_chunk, chunks, resources.pop_all()),
             media_type='text/csv',
             headers={"Content-Disposition": f"attachment; filename={CSV_FILENAME}"}
         )
@@ -339,74 +601,88 @@ async def sqlquery(sqlquery: str, cloud: str, request: Request, format: str = "j
         logger.error(f"Error executing query: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        if connection:
-            pools = getattr(app.state, "db_pools", {})
-            meta = pools.get(cloud)
-            if meta:
-                logger.debug(f"Releasing pooled connection for cloud: {cloud}")
-                try:
-                    if meta["db_type"] == "mysql":
-                        meta["pool"].release(connection)
-                    else:
-                        await meta["pool"].release(connection)
-                except Exception as close_exc:
-                    logger.error(f"Error while releasing connection for {cloud}: {close_exc}")
-
-@app.middleware("http")
-async def log_request_headers(request: Request, call_next):
+        await resources.aclose()
+
+# Request headers included in the access log, as raw lowercase ASGI names
+_LOGGED_HEADERS = (
+    b"x-forwarded-for",
+    b"x-real-ip",
+    b"origin",
+    b"referer",
+    b"user-agent",
+    b"accept",
+    b"accept-language",
+    b"accept-encoding",
+    b"content-type",
+    b"authorization",
+)
+
+def _truncate_header(value: bytes, max_len: int = 100) -> str:
+    """Decode a raw header value, keeping at most max_len characters."""
+    # latin-1 maps bytes 1:1 to characters, so slicing before decoding is exact
+    if len(value) > max_len:
+        return value[:max_len].decode("latin-1") + "..."
+    return value.decode("latin-1")
+
+class LogHeadersMiddleware:
     """Log important request headers for monitoring and security purposes."""
-    # Get client IP (considering proxies)
-    client_ip = request.headers.get("x-forwarded-for", "").split(",")[0].strip()
-    if not client_ip:
-        client_ip = request.headers.get("x-real-ip", "")
-    if not client_ip:
-        client_ip = getattr(request.client, "host", "unknown") if request.client else "unknown"
-    
-    # Get important headers
-    origin = request.headers.get("origin", "")
-    referer = request.headers.get("referer", "")
-    user_agent = request.headers.get("user-agent", "")
-    accept = request.headers.get("accept", "")
-    accept_language = request.headers.get("accept-language", "")
-    accept_encoding = request.headers.get("accept-encoding", "")
-    content_type = request.headers.get("content-type", "")
-    authorization = "Bearer ***" if request.headers.get("authorization") else ""
-    
-    # Log the headers (truncate long values to prevent log spam)
-    def truncate(value: str, max_len: int = 100) -> str:
-        return value[:max_len] + "..." if len(value) > max_len else value
-    
-    logger.info(
-        f"Request: {request.method} {request.url.path} | "
-        f"IP={client_ip} | "
-        f"Origin={truncate(origin)} | "
-        f"Referer={truncate(referer)} | "
-        f"User-Agent={truncate(user_agent)} | "
-        f"Accept={truncate(accept)} | "
-        f"Accept-Lang={truncate(accept_language)} | "
-        f"Accept-Enc={truncate(accept_encoding)} | "
-        f"Content-Type={truncate(content_type)} | "
-        f"Auth={authorization}"
-    )
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Skip all header work when the access log line would be discarded anyway
+        if scope["type"] != "http" or not logger.isEnabledFor(logging.INFO):
+            await self.app(scope, receive, send)
+            return
+
+        # Collect the logged headers in one pass over the raw ASGI header list
+        headers = dict.fromkeys(_LOGGED_HEADERS, b"")
+        for key, value in scope["headers"]:
+            if key in headers and not headers[key]:
+                headers[key] = value
+
+        # Get client IP (considering proxies)
+        # First hop only: partition the raw bytes instead of splitting the whole chain
+        client_ip = headers[b"x-forwarded-for"].partition(b",")[0].strip().decode("latin-1")
+        if not client_ip:
+            client_ip = headers[b"x-real-ip"].decode("latin-1")
+        if not client_ip:
+            client_ip = (scope.get("client") or ("unknown", 0))[0]
     
-    response = await call_next(request)
-    return response
-
-@app.middleware("http")
-async def remove_temp_file(request, call_next):
-    logger.debug(f"Processing request: {request.url}")
-    response = await call_next(request)
-    if isinstance(response, FileResponse) and os.path.exists(response.path):
-        try:
-            os.remove(response.path)
-            logger.debug(f"Temporary file {response.path} removed successfully")
-        except Exception as e:
-            logger.error(f"Error removing temp file: {e}")
-    return response
+        # Log the headers (truncate long values to prevent log spam)
+        logger.info(
+            "Request: %s %s | IP=%s | Origin=%s | Referer=%s | User-Agent=%s | "
+            "Accept=%s | Accept-Lang=%s | Accept-Enc=%s | Content-Type=%s | Auth=%s",
+            scope["method"],
+            scope["path"],
+            client_ip,
+            _truncate_header(headers[b"origin"]),
+            _truncate_header(headers[b"referer"]),
+            _truncate_header(headers[b"user-agent"]),
+            _truncate_header(headers[b"accept"]),
+            _truncate_header(headers[b"accept-language"]),
+            _truncate_header(headers[b"accept-encoding"]),
+            _truncate_header(headers[b"content-type"]),
+            "Bearer ***" if headers[b"authorization"] else "",
+        )
+
+        await self.app(scope, receive, send)
+
+app.add_middleware(LogHeadersMiddleware)
 
 # Removed unused generate_table_name
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
+    # "auto" selects uvloop whenever it is installed (it is not available on Windows);
+    # httptools provides the C HTTP parser. Workers need the app as an import string.
+    uvicorn.run(
+        "app:app",
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        loop="auto",
+        http="httptools",
+        workers=WEB_CONCURRENCY,
+    )
 